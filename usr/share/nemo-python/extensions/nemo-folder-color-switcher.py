@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import fcntl
 import gettext
 import gi
 import json
@@ -8,6 +9,7 @@ import locale
 import os
 import re
 import subprocess
+import threading
 
 gi.require_version('Gtk', '3.0')
 gi.require_version('Nemo', '3.0')
@@ -62,6 +64,157 @@ color_names = [
     _('Yellow')
 ]
 
+class IconCache(object):
+    # Icon lookups shared by every file manager process loading this
+    # extension (nemo, nemo-desktop, caja). Entries are grouped per icon
+    # theme and are dropped as soon as that theme's (or a parent theme's)
+    # icon cache changes.
+    VERSION = 1
+
+    def __init__(self):
+        self.path = os.path.join(GLib.get_user_cache_dir(), "folder-color-switcher", "icon-cache.json")
+        self.search_path = Gtk.IconTheme.get_default().get_search_path()
+        self.file_id = None
+        self.themes = {}
+        self.theme_mtimes = {}
+        self.pending = []
+
+    @staticmethod
+    def get_key(icon_name, size, scale):
+        return "%s:%i:%i" % (icon_name, size, scale)
+
+    def get_theme_mtime(self, icon_theme_name):
+        # The most recent icon-theme.cache (or index.theme when the theme has no cache)
+        # across all the icon directories providing this theme and the themes it inherits from.
+        # hicolor changes whenever an application gets installed, so it is left out,
+        # lookup() checks that the icon still exists instead.
+        mtime = 0
+        theme_names = [icon_theme_name]
+        for theme_name in theme_names:
+            for directory in self.search_path:
+                theme_dir = os.path.join(directory, theme_name)
+                for filename in ("icon-theme.cache", "index.theme"):
+                    try:
+                        mtime = max(mtime, os.stat(os.path.join(theme_dir, filename)).st_mtime_ns)
+                    except OSError:
+                        pass
+
+                keyfile = GLib.KeyFile()
+                try:
+                    keyfile.load_from_file(os.path.join(theme_dir, "index.theme"), GLib.KeyFileFlags.NONE)
+                    parents = keyfile.get_string_list("Icon Theme", "Inherits")
+                except GLib.Error:
+                    continue
+                for parent in parents:
+                    if parent != "hicolor" and parent not in theme_names:
+                        theme_names.append(parent)
+        return mtime
+
+    def get_cached_theme_mtime(self, icon_theme_name):
+        # Computed once, until the cache file or the icon theme changes
+        if icon_theme_name not in self.theme_mtimes:
+            self.theme_mtimes[icon_theme_name] = self.get_theme_mtime(icon_theme_name)
+        return self.theme_mtimes[icon_theme_name]
+
+    def reload(self):
+        # Only re-read the file if another process replaced it since we last looked.
+        # Each replacement is a new inode, the mtime alone can be the same for two quick writes.
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.file_id = None
+            self.themes = {}
+            return
+
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if file_id != self.file_id:
+            self.file_id = file_id
+            self.themes = self.read()
+            self.theme_mtimes = {}
+
+    def read(self):
+        # Anything that doesn't look like what we write is ignored, so a bad file is just a miss
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.debug("Ignoring invalid icon cache %s: %s", self.path, e)
+            return {}
+
+        themes = {}
+        if not isinstance(data, dict) or data.get("version") != self.VERSION or not isinstance(data.get("themes"), dict):
+            logger.debug("Ignoring invalid icon cache %s", self.path)
+            return themes
+
+        for icon_theme_name, theme in data["themes"].items():
+            if isinstance(theme, dict) and isinstance(theme.get("mtime"), int) and isinstance(theme.get("icons"), dict):
+                icons = {key: uri for key, uri in theme["icons"].items() if isinstance(uri, str)}
+                themes[icon_theme_name] = {"mtime": theme["mtime"], "icons": icons}
+        return themes
+
+    def lookup(self, icon_theme_name, icon_name, size, scale):
+        self.reload()
+        theme = self.themes.get(icon_theme_name)
+        if theme is None or theme["mtime"] != self.get_cached_theme_mtime(icon_theme_name):
+            return None
+
+        uri = theme["icons"].get(self.get_key(icon_name, size, scale))
+        if uri is None:
+            return None
+
+        try:
+            filename, hostname = GLib.filename_from_uri(uri)
+        except GLib.Error:
+            return None
+        if not os.path.exists(filename):
+            logger.debug("Ignoring cached icon %s, the file is gone", uri)
+            return None
+        return uri
+
+    def store(self, icon_theme_name, icon_name, size, scale, uri):
+        # Kept in memory until save(), so that batches of lookups only write the file once.
+        # The theme mtime is taken now, so that save() can tell if the theme changed in between.
+        theme_mtime = self.get_cached_theme_mtime(icon_theme_name)
+        self.pending.append((icon_theme_name, theme_mtime, self.get_key(icon_name, size, scale), uri))
+
+    def save(self):
+        if not self.pending:
+            return
+
+        # Written from a thread, the main loop only picks the new file up on its next lookup
+        pending = self.pending
+        self.pending = []
+        threading.Thread(target=self.write, args=(pending,), daemon=True).start()
+
+    def write(self, pending):
+        # Merge into the latest version of the file, then replace it atomically.
+        # The lock keeps processes saving at the same time from dropping each other's entries.
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                themes = self.read()
+                theme_mtimes = {}
+                for icon_theme_name, theme_mtime, key, uri in pending:
+                    if icon_theme_name not in theme_mtimes:
+                        theme_mtimes[icon_theme_name] = self.get_theme_mtime(icon_theme_name)
+                    if theme_mtime != theme_mtimes[icon_theme_name]:
+                        # resolved against an older version of the theme
+                        continue
+                    theme = themes.get(icon_theme_name)
+                    if theme is None or theme["mtime"] != theme_mtime:
+                        theme = {"mtime": theme_mtime, "icons": {}}
+                        themes[icon_theme_name] = theme
+                    theme["icons"][key] = uri
+
+                data = json.dumps({"version": self.VERSION, "themes": themes})
+                GLib.file_set_contents(self.path, data.encode())
+        except (OSError, GLib.Error) as e:
+            logger.warning("Failed to write icon cache %s: %s", self.path, e)
+
 class ChangeFolderColorBase(object):
     # view[zoom-level] -> icon size
     # Notes:
@@ -99,8 +252,25 @@ class ChangeFolderColorBase(object):
         GLib.get_home_dir(): 'user-home'
     }
 
+    # how long (in microseconds) the icon warmer may run before yielding to the main loop
+    WARM_TIME_SLICE = 5000
+
     def __init__(self):
         self.parent_directory = None
+        self.icon_cache = IconCache()
+
+        # icon URIs resolved in this process: (theme, icon name, size, scale) -> URI
+        self.icon_uris = {}
+        self.icon_themes = {}
+        self.warm_source_id = 0
+        self.warm_sizes = []
+        self.style_theme_mtimes = {}
+
+        display = Gdk.Display.get_default()
+        monitor = display.get_monitor(0) if display else None
+        self.scale_factor = monitor.get_scale_factor() if monitor else 1
+        # the scale the warmer resolves icons for, clicks may happen at another one
+        self.warm_scale = self.scale_factor
 
         # view preferences
         self.ignore_view_metadata = False
@@ -130,15 +300,58 @@ class ChangeFolderColorBase(object):
                         print(f"Failed to parse styles from {filename}.")
                         print(e)
 
+        # Pre-resolve the color icons whenever the icon theme or the default zoom levels change
+        Gtk.Settings.get_default().connect("notify::gtk-icon-theme-name", self.on_icon_theme_name_changed)
+        Gtk.IconTheme.get_default().connect("changed", self.on_icon_theme_changed)
+        self.zoom_settings = {}
+        for view in self.ZOOM_LEVEL_ICON_SIZES.keys():
+            self.zoom_settings[view] = Gio.Settings.new("org.nemo.%s" % view)
+            self.zoom_settings[view].connect("changed::default-zoom-level", self.on_default_zoom_level_changed)
+        self.queue_warm_icon_uris()
+
     def on_ignore_view_metadata_changed(self, settings, key="ignore-view-metadata"):
         self.ignore_view_metadata = self.nemo_settings.get_boolean(key)
 
     def on_default_view_changed(self, settings, key="default-folder-viewer"):
         self.default_view = self.nemo_settings.get_string(key)
 
-    @staticmethod
-    def get_default_view_zoom_level(view="icon-view"):
-        zoom_lvl_string = Gio.Settings.new("org.nemo.%s" % view).get_string("default-zoom-level")
+    def on_icon_theme_name_changed(self, settings, pspec):
+        self.reset_icon_uris()
+
+    def on_icon_theme_changed(self, icon_theme):
+        # The default theme also rescans when e.g. an application installs icons into hicolor,
+        # only start over if one of the color themes (or their parents) actually changed
+        if self.get_style_theme_mtimes() != self.style_theme_mtimes:
+            self.reset_icon_uris()
+
+    def reset_icon_uris(self):
+        self.icon_uris = {}
+        self.icon_themes = {}
+        self.icon_cache.pending = []
+        self.icon_cache.theme_mtimes = {}
+        self.queue_warm_icon_uris()
+
+    def get_style_theme_mtimes(self):
+        icon_theme_name = Gtk.Settings.get_default().get_property("gtk-icon-theme-name")
+        if icon_theme_name not in self.styles:
+            return {}
+
+        theme_mtimes = {}
+        for icon_theme in self.styles[icon_theme_name]["icon-themes"]:
+            theme_mtimes[icon_theme["theme"]] = self.icon_cache.get_theme_mtime(icon_theme["theme"])
+        return theme_mtimes
+
+    def on_default_zoom_level_changed(self, settings, key):
+        # Every size gets warmed anyway, just move the new default one to the front of the queue
+        if self.default_view in self.ZOOM_LEVEL_ICON_SIZES.keys():
+            size = self.get_default_view_icon_size()
+            if size in self.warm_sizes:
+                self.warm_sizes.remove(size)
+                self.warm_sizes.insert(0, size)
+
+    def get_default_view_zoom_level(self, view="icon-view"):
+        settings = self.zoom_settings.get(view) or Gio.Settings.new("org.nemo.%s" % view)
+        zoom_lvl_string = settings.get_string("default-zoom-level")
         return ChangeFolderColorBase.ZOOM_LEVELS[zoom_lvl_string]
 
     def get_default_view_icon_size(self):
@@ -190,20 +403,87 @@ class ChangeFolderColorBase(object):
         logger.debug("falling back to defaults")
         return self.get_default_view_icon_size()
 
-    def get_icon_uri_for_color_size_and_scale(self, icon_name: str, icon_theme_name: str, size: int, scale: int) -> str:
-        logger.debug('Searching: icon "%s" for theme "%s", size %i and scale %i', icon_name, icon_theme_name, size, scale)
-
-        icon_theme = Gtk.IconTheme.new()
-        icon_theme.set_custom_theme(icon_theme_name)
-        if icon_theme is not None:
-            icon_info = icon_theme.choose_icon_for_scale([icon_name, None], size, scale, 0)
+    def get_icon_theme(self, icon_theme_name):
+        icon_theme = self.icon_themes.get(icon_theme_name)
+        if icon_theme is None:
+            icon_theme = Gtk.IconTheme.new()
+            icon_theme.set_custom_theme(icon_theme_name)
+            self.icon_themes[icon_theme_name] = icon_theme
+        return icon_theme
+
+    def resolve_icon_uri(self, icon_name, icon_theme_name, size, scale):
+        key = (icon_theme_name, icon_name, size, scale)
+        if key in self.icon_uris:
+            return self.icon_uris[key]
+
+        uri = self.icon_cache.lookup(icon_theme_name, icon_name, size, scale)
+        if uri is not None:
+            logger.debug("Found cached icon at URI: %s", uri)
+        else:
+            logger.debug('Searching: icon "%s" for theme "%s", size %i and scale %i', icon_name, icon_theme_name, size, scale)
+            icon_info = self.get_icon_theme(icon_theme_name).choose_icon_for_scale([icon_name, None], size, scale, 0)
             if icon_info:
                 uri = GLib.filename_to_uri(icon_info.get_filename(), None)
                 logger.debug("Found icon at URI: %s", uri)
-                return uri
+                self.icon_cache.store(icon_theme_name, icon_name, size, scale, uri)
+            else:
+                logger.debug('No icon "%s" found for theme "%s", size %i and scale %i', icon_name, icon_theme_name, size, scale)
+
+        self.icon_uris[key] = uri
+        return uri
+
+    def get_icon_uri_for_color_size_and_scale(self, icon_name: str, icon_theme_name: str, size: int, scale: int) -> str:
+        uri = self.resolve_icon_uri(icon_name, icon_theme_name, size, scale)
+        self.icon_cache.save()
+        return uri
+
+    def queue_warm_icon_uris(self, *args):
+        # (Re)start the warmer from scratch, already resolved icons are skipped quickly
+        if self.warm_source_id:
+            GLib.source_remove(self.warm_source_id)
+        self.warm_source_id = GLib.idle_add(self.on_warm_icon_uris_idle, self.warm_icon_uris(), priority=GLib.PRIORITY_LOW)
+
+    def on_warm_icon_uris_idle(self, warmer):
+        deadline = GLib.get_monotonic_time() + self.WARM_TIME_SLICE
+        for step in warmer:
+            if GLib.get_monotonic_time() >= deadline:
+                return GLib.SOURCE_CONTINUE
+
+        self.warm_source_id = 0
+        self.icon_cache.save()
+        return GLib.SOURCE_REMOVE
+
+    def warm_icon_uris(self):
+        # Resolves every color of the active style, one icon per step,
+        # starting with the icon size of the default view.
+        # on_default_zoom_level_changed() may reorder self.warm_sizes while this runs.
+        icon_theme_name = Gtk.Settings.get_default().get_property("gtk-icon-theme-name")
+        self.style_theme_mtimes = self.get_style_theme_mtimes()
+        if icon_theme_name not in self.styles:
+            return
 
-        logger.debug('No icon "%s" found for color "%s", size %i and scale %i', icon_name, color, size, scale)
-        return None
+        # the theme mtimes are checked once per pass rather than for every icon
+        self.icon_cache.theme_mtimes.update(self.style_theme_mtimes)
+
+        sizes = []
+        if self.default_view in self.ZOOM_LEVEL_ICON_SIZES.keys():
+            sizes.append(self.get_default_view_icon_size())
+        for view_sizes in self.ZOOM_LEVEL_ICON_SIZES.values():
+            for size in view_sizes:
+                if size not in sizes:
+                    sizes.append(size)
+
+        icon_names = ['folder'] + list(self.KNOWN_DIRECTORIES.values())
+        scale = self.warm_scale
+        logger.debug("Warming icons for theme %s, sizes %s and scale %i", icon_theme_name, sizes, scale)
+
+        self.warm_sizes = sizes
+        while self.warm_sizes:
+            size = self.warm_sizes.pop(0)
+            for icon_theme in self.styles[icon_theme_name]["icon-themes"]:
+                for icon_name in icon_names:
+                    self.resolve_icon_uri(icon_name, icon_theme["theme"], size, scale)
+                    yield
 
     def set_folder_colors(self, folders, icon_theme):
         self.parent_directory = folders[0].get_parent_info()
@@ -343,6 +623,9 @@ class ChangeFolderColor(ChangeFolderColorBase, GObject.GObject, Nemo.MenuProvide
 
         widget = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 1)
         self.scale_factor = widget.get_scale_factor()
+        if self.scale_factor != self.warm_scale:
+            self.warm_scale = self.scale_factor
+            self.queue_warm_icon_uris()
 
         # Generate restore button
         button = self.make_button(None)